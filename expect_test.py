@@ -3,8 +3,11 @@ Expect Test Framework for Python
 A snapshot testing library inspired by Jane Street's expect tests.
 """
 
+import atexit
 import json
+import mmap
 import os
+import re
 import sys
 import hashlib
 import difflib
@@ -12,10 +15,14 @@ import inspect
 import functools
 from pathlib import Path
 from typing import Any, Callable, Optional, Union
-from dataclasses import dataclass, asdict
 from datetime import datetime
 from enum import Enum
 
+try:
+    import orjson  # Optional: 2-10x faster JSON encode/decode on the hot paths
+except ImportError:
+    orjson = None
+
 
 class ConflictResolution(Enum):
     """Conflict resolution strategies"""
@@ -25,26 +32,6 @@ class ConflictResolution(Enum):
     FAIL = "fail"
 
 
-@dataclass
-class TestSnapshot:
-    """Represents a test snapshot"""
-    name: str
-    value: Any
-    timestamp: str
-    file_path: str
-    line_number: int
-    hash: str
-    
-    def to_dict(self):
-        return {
-            "value": self.value,
-            "timestamp": self.timestamp,
-            "file_path": self.file_path,
-            "line_number": self.line_number,
-            "hash": self.hash
-        }
-
-
 class ExpectTestConfig:
     """Global configuration for expect tests"""
     def __init__(self):
@@ -63,78 +50,200 @@ class ExpectTestConfig:
 # Global config instance
 config = ExpectTestConfig()
 
+# Snapshot timestamps are only meaningful at run granularity, so compute
+# one per process instead of once per updated test
+_RUN_TIMESTAMP = datetime.now().isoformat()
+
 
 class SnapshotManager:
-    """Manages snapshot storage and retrieval"""
-    
-    def __init__(self, snapshot_file: Optional[str] = None):
-        self.snapshot_file = snapshot_file or self._get_default_snapshot_file()
-        self.snapshots = self._load_snapshots()
+    """Manages snapshot storage and retrieval.
+
+    Snapshots are sharded one file per test under a snapshot directory,
+    so a run only reads and rewrites the snapshots it actually touches
+    instead of re-parsing and re-serializing one monolithic JSON blob.
+    A pre-sharding ``<dir>.json`` file is still read as a fallback.
+    """
+
+    # Flush pending updates to disk after this many accumulated changes,
+    # so a crash mid-run loses at most one batch
+    BATCH_SIZE = 64
+
+    def __init__(self, snapshot_dir: Optional[str] = None):
+        self.snapshot_dir = snapshot_dir or self._get_default_snapshot_dir()
+        # Managers are cached per directory, so this is the one place
+        # directory creation needs to happen
+        Path(self.snapshot_dir).mkdir(parents=True, exist_ok=True)
+        self.snapshots = {}
+        self._legacy_loaded = False
         self.pending_updates = {}
-        
-    def _get_default_snapshot_file(self) -> str:
-        """Get the default snapshot file path based on the calling test file"""
-        frame = inspect.currentframe()
-        for _ in range(10):  # Look up the stack
-            frame = frame.f_back
-            if frame is None:
-                break
-            filename = frame.f_code.co_filename
-            if filename.endswith(".py") and not filename.endswith("expect_test.py"):
-                base_name = Path(filename).stem
-                snapshot_dir = Path(filename).parent / config.snapshot_dir
-                snapshot_dir.mkdir(exist_ok=True)
-                return str(snapshot_dir / f"{base_name}.json")
-        
-        # Fallback
-        snapshot_dir = Path(config.snapshot_dir)
-        snapshot_dir.mkdir(exist_ok=True)
-        return str(snapshot_dir / "default_snapshots.json")
-    
-    def _load_snapshots(self) -> dict:
-        """Load existing snapshots from file"""
-        if os.path.exists(self.snapshot_file):
-            try:
-                with open(self.snapshot_file, 'r') as f:
-                    return json.load(f)
-            except json.JSONDecodeError:
-                print(f"Warning: Could not parse {self.snapshot_file}, starting fresh")
-                return {}
-        return {}
-    
+        # Names whose shard file has already been checked on disk
+        self._probed = set()
+        # Canonical JSON bytes per test, so repeat runs compare bytes
+        # instead of recursively comparing nested Python structures
+        self._canonical_cache = {}
+
+    @staticmethod
+    def _get_default_snapshot_dir() -> str:
+        """Fallback snapshot directory for when no calling test file is known"""
+        return str(Path(config.snapshot_dir) / "default_snapshots")
+
+    def _shard_path(self, test_name: str) -> str:
+        """Path of the per-test snapshot file"""
+        if len(test_name) <= 100 and re.fullmatch(r'[a-z0-9_.-]+', test_name):
+            shard_name = test_name
+        else:
+            # Unsafe characters, over-long names (filesystems cap
+            # filenames around 255 bytes) and names that differ only by
+            # case (which collide on case-insensitive filesystems) all
+            # take a digest, with a readable prefix where possible
+            digest = hashlib.sha1(test_name.encode()).hexdigest()
+            prefix = re.sub(r'[^a-z0-9_.-]', '_', test_name.lower())[:60]
+            shard_name = f"{prefix}-{digest[:12]}" if prefix else digest
+        return os.path.join(self.snapshot_dir, f"{shard_name}.json")
+
+    def _ensure_legacy_loaded(self):
+        """Parse a pre-sharding monolithic snapshot file on first miss.
+
+        The file is mapped rather than read so nothing is copied or
+        paged in unless a lookup actually falls through to it.
+        """
+        if self._legacy_loaded:
+            return
+        self._legacy_loaded = True
+        legacy_file = f"{self.snapshot_dir}.json"
+        try:
+            with open(legacy_file, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    legacy = _loads(memoryview(buf) if orjson is not None
+                                    else bytes(buf))
+        except FileNotFoundError:
+            return
+        except ValueError:
+            print(f"Warning: Could not parse {legacy_file}, starting fresh")
+            return
+        # Shard files supersede legacy entries
+        for test_name, snapshot_data in legacy.items():
+            self.snapshots.setdefault(test_name, snapshot_data)
+
+    def _read_shard(self, test_name: str) -> Optional[dict]:
+        """Read a single per-test snapshot file, via the shared cache.
+
+        Parsed envelopes are shared process-wide and revalidated by
+        mtime, so independently constructed managers (e.g. repeated
+        direct SnapshotManager use) never re-parse an unchanged shard.
+        """
+        path = self._shard_path(test_name)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        cached = _SHARD_CACHE.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+        try:
+            with open(path, 'rb') as f:
+                snapshot_data = _loads(f.read())
+        except ValueError:
+            print(f"Warning: Could not parse {path}, starting fresh")
+            return None
+        _SHARD_CACHE[path] = (mtime_ns, snapshot_data)
+        return snapshot_data
+
     def _save_snapshots(self):
-        """Save snapshots to file"""
-        # Merge pending updates
-        self.snapshots.update(self.pending_updates)
-        
-        # Ensure directory exists
-        Path(self.snapshot_file).parent.mkdir(parents=True, exist_ok=True)
-        
-        with open(self.snapshot_file, 'w') as f:
-            json.dump(self.snapshots, f, indent=2, sort_keys=True, default=str)
-        
-        self.pending_updates.clear()
-    
+        """Write pending updates to disk, one file per test.
+
+        Each shard is written to a tempfile, fsynced, and moved into
+        place with os.replace, so neither a crash mid-write nor a power
+        loss right after the rename can surface a truncated file — a
+        corrupt shard would otherwise be silently discarded as
+        unparseable on the next run, losing the snapshot.
+        """
+        for test_name, snapshot_data in self.pending_updates.items():
+            path = self._shard_path(test_name)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(_dumps_pretty(snapshot_data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            try:
+                _SHARD_CACHE[path] = (os.stat(path).st_mtime_ns, snapshot_data)
+            except OSError:
+                pass
+
+        # Install a new merged mapping instead of mutating in place, so
+        # anything still holding the previous mapping sees a stable view
+        self.snapshots = {**self.snapshots, **self.pending_updates}
+        self.pending_updates = {}
+
+    def _get_envelope(self, test_name: str) -> Optional[dict]:
+        """Get the full stored envelope (value plus metadata) for a test"""
+        if test_name in self.pending_updates:
+            return self.pending_updates[test_name]
+        if test_name not in self._probed:
+            # Shard files are read lazily and supersede any legacy entry
+            self._probed.add(test_name)
+            snapshot_data = self._read_shard(test_name)
+            if snapshot_data is not None:
+                self.snapshots[test_name] = snapshot_data
+        if test_name not in self.snapshots:
+            self._ensure_legacy_loaded()
+        return self.snapshots.get(test_name)
+
     def get_snapshot(self, test_name: str) -> Optional[Any]:
         """Get existing snapshot for a test"""
-        if test_name in self.pending_updates:
-            return self.pending_updates[test_name]["value"]
-        if test_name in self.snapshots:
-            return self.snapshots[test_name]["value"]
-        return None
+        snapshot_data = self._get_envelope(test_name)
+        return snapshot_data["value"] if snapshot_data is not None else None
     
-    def update_snapshot(self, test_name: str, value: Any, metadata: dict):
+    def update_snapshot(self, test_name: str, value: Any, metadata: dict,
+                        canonical: Optional[bytes] = None):
         """Update or create a snapshot"""
+        canonical = canonical or _canonical_bytes(value)
+        # On-disk envelope: "value" plus "timestamp", a content hash and
+        # the caller's location metadata (file_path, line_number, ...)
         snapshot_data = {
             "value": value,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": _RUN_TIMESTAMP,
+            "hash": _digest(canonical),
             **metadata
         }
         self.pending_updates[test_name] = snapshot_data
-    
+        self._canonical_cache[test_name] = canonical
+        if len(self.pending_updates) >= self.BATCH_SIZE:
+            self._save_snapshots()
+
     def has_snapshot(self, test_name: str) -> bool:
-        """Check if snapshot exists"""
-        return test_name in self.snapshots or test_name in self.pending_updates
+        """Check if snapshot exists.
+
+        Answers via the same lookup the readers use, so an unparseable
+        shard counts as absent and gets recreated instead of surfacing
+        as a phantom snapshot that can never match.
+        """
+        return self._get_envelope(test_name) is not None
+
+    def matches(self, test_name: str, canonical: bytes) -> bool:
+        """Compare canonical bytes against the stored snapshot's canonical form.
+
+        Always derived from the stored value, never from the envelope's
+        "hash" field: snapshot files are reviewed and hand-edited, so a
+        stale hash next to an edited value must not make a test pass.
+        """
+        cached = self._canonical_cache.get(test_name)
+        if cached is None:
+            snapshot_data = self._get_envelope(test_name)
+            if snapshot_data is None:
+                return False
+            cached = _canonical_bytes(snapshot_data["value"])
+            self._canonical_cache[test_name] = cached
+        if cached == canonical:
+            return True
+        # Byte mismatches can be spurious when the two sides were
+        # serialized differently (e.g. stdlib sorts int keys
+        # numerically, orjson sorts their string form); confirm with
+        # one deep compare before reporting a conflict
+        snapshot_data = self._get_envelope(test_name)
+        return (snapshot_data is not None
+                and _loads(canonical) == snapshot_data["value"])
     
     def commit_updates(self):
         """Commit all pending updates to disk"""
@@ -142,32 +251,145 @@ class SnapshotManager:
             self._save_snapshots()
 
 
-def _serialize_value(value: Any) -> Any:
-    """Convert value to JSON-serializable format"""
-    if value is None:
-        return None
-    elif isinstance(value, (str, int, float, bool)):
-        return value
-    elif isinstance(value, (list, tuple)):
-        return [_serialize_value(v) for v in value]
-    elif isinstance(value, dict):
-        return {k: _serialize_value(v) for k, v in value.items()}
-    elif hasattr(value, '__dict__'):
-        # For custom objects, try to convert to dict
-        return _serialize_value(vars(value))
-    else:
-        # Fallback to string representation
-        return str(value)
+# Managers cached per resolved snapshot directory, so each store is set
+# up once per process instead of once per test invocation
+_MANAGERS: dict = {}
+
+# Parsed shard envelopes shared across all managers, validated by mtime:
+# path -> (st_mtime_ns, envelope). Entries are treated as read-only;
+# writers install fresh envelopes rather than mutating cached ones.
+_SHARD_CACHE: dict = {}
+
+
+def _snapshot_dir_for(source_file: str) -> str:
+    """Compute the snapshot directory for a test source file"""
+    source = Path(source_file)
+    return str(source.parent / config.snapshot_dir / source.stem)
+
+
+def _get_manager(snapshot_dir: Optional[str] = None) -> SnapshotManager:
+    """Get the shared SnapshotManager for a snapshot directory, creating it on first use"""
+    path = snapshot_dir or SnapshotManager._get_default_snapshot_dir()
+    key = str(Path(path).resolve())
+    manager = _MANAGERS.get(key)
+    if manager is None:
+        manager = _MANAGERS[key] = SnapshotManager(path)
+    return manager
+
+
+def _flush_all():
+    """Flush pending updates for every cached manager at interpreter shutdown"""
+    for manager in _MANAGERS.values():
+        try:
+            manager.commit_updates()
+        except OSError as e:
+            # Keep flushing the remaining managers; one bad path must
+            # not drop everyone else's pending snapshots
+            print(f"Warning: Could not write snapshots under "
+                  f"{manager.snapshot_dir}: {e}")
+
+
+atexit.register(_flush_all)
+
+
+def _json_default(o: Any) -> Any:
+    """Fallback serializer for objects json.dumps can't handle natively"""
+    # Enums serialize as their value on both backends (orjson would do
+    # this natively; the stdlib would otherwise leak the member's
+    # internal __dict__)
+    if isinstance(o, Enum):
+        return o.value
+    # Custom objects become their attribute dict; anything else a
+    # string. One getattr instead of hasattr + vars — this runs once
+    # per non-native node in the result tree.
+    attrs = getattr(o, '__dict__', None)
+    return attrs if attrs is not None else str(o)
+
+
+def _canonical_bytes(value: Any) -> bytes:
+    """Serialize a value to canonical JSON bytes in one pass"""
+    if orjson is not None:
+        try:
+            # Datetimes pass through to _json_default so both backends
+            # produce identical bytes for the same value
+            return orjson.dumps(value,
+                                option=orjson.OPT_SORT_KEYS
+                                | orjson.OPT_PASSTHROUGH_DATETIME,
+                                default=_json_default)
+        except TypeError:
+            pass  # e.g. ints beyond 64 bits; fall back to stdlib json
+    # Compact separators and raw UTF-8 match orjson's output, so a value
+    # that takes this fallback still compares equal to one that didn't
+    return json.dumps(value, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False, default=_json_default).encode()
+
+
+def _dumps_pretty(value: Any) -> bytes:
+    """Serialize a value to indented JSON bytes for files and diffs"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value,
+                                option=orjson.OPT_SORT_KEYS
+                                | orjson.OPT_INDENT_2
+                                | orjson.OPT_PASSTHROUGH_DATETIME,
+                                default=_json_default)
+        except TypeError:
+            pass
+    return json.dumps(value, indent=2, sort_keys=True, ensure_ascii=False,
+                      default=_json_default).encode()
+
+
+def _loads(data: bytes) -> Any:
+    """Deserialize JSON bytes"""
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _digest(canonical: bytes) -> str:
+    """Content digest of canonical bytes for cheap change detection.
+
+    BLAKE2b is considerably faster than MD5 on CPython, and the input is
+    bytes we already hold — no extra serialization pass.
+    """
+    return hashlib.blake2b(canonical, digest_size=16).hexdigest()
+
+
+_HUNK_HEADER = re.compile(r'^@@ -(\d+)((?:,\d+)?) \+(\d+)((?:,\d+)?) @@')
+
+
+def _trim_common(old_lines: list, new_lines: list):
+    """Strip common leading/trailing lines before diffing.
+
+    difflib degenerates on large inputs, but snapshot changes are
+    usually local; giving the matcher only the differing middle keeps
+    its cost proportional to the change, not the snapshot.
+    Returns (prefix_len, suffix_len, old_middle, new_middle).
+    """
+    limit = min(len(old_lines), len(new_lines))
+    prefix = 0
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix
+           and old_lines[-1 - suffix] == new_lines[-1 - suffix]):
+        suffix += 1
+    return (prefix, suffix,
+            old_lines[prefix:len(old_lines) - suffix],
+            new_lines[prefix:len(new_lines) - suffix])
 
 
 def _show_diff(old_value: Any, new_value: Any, test_name: str):
     """Display a colored diff between old and new values"""
-    old_str = json.dumps(old_value, indent=2, sort_keys=True, default=str)
-    new_str = json.dumps(new_value, indent=2, sort_keys=True, default=str)
-    
-    diff = difflib.unified_diff(
+    old_str = _dumps_pretty(old_value).decode()
+    new_str = _dumps_pretty(new_value).decode()
+
+    prefix, _suffix, old_mid, new_mid = _trim_common(
         old_str.splitlines(keepends=True),
-        new_str.splitlines(keepends=True),
+        new_str.splitlines(keepends=True)
+    )
+
+    diff = difflib.unified_diff(
+        old_mid,
+        new_mid,
         fromfile=f"{test_name} (expected)",
         tofile=f"{test_name} (actual)",
         lineterm=''
@@ -183,7 +405,16 @@ def _show_diff(old_value: Any, new_value: Any, test_name: str):
     print('='*60)
     
     for line in diff:
-        if line.startswith('+') and not line.startswith('+++'):
+        if line.startswith('@@'):
+            # Hunk positions are relative to the trimmed middle; shift
+            # them back to full-snapshot line numbers
+            line = _HUNK_HEADER.sub(
+                lambda m: f"@@ -{int(m.group(1)) + prefix}{m.group(2)} "
+                          f"+{int(m.group(3)) + prefix}{m.group(4)} @@",
+                line
+            )
+            print(line, end='')
+        elif line.startswith('+') and not line.startswith('+++'):
             print(f"{GREEN}{line}{RESET}", end='')
         elif line.startswith('-') and not line.startswith('---'):
             print(f"{RED}{line}{RESET}", end='')
@@ -227,76 +458,91 @@ def _handle_conflict(test_name: str, old_value: Any, new_value: Any,
                 print("Invalid input. Use 'y' (yes), 'n' (no), 'd' (show diff), or 'q' (quit)")
 
 
-def expect(test_name: str, snapshot_file: Optional[str] = None):
+def _compare_and_store(manager: SnapshotManager, test_name: str,
+                       canonical: bytes, metadata: dict):
+    """Compare a result's canonical bytes against the stored snapshot.
+
+    Creates the snapshot if missing, passes silently on a match, and
+    otherwise runs conflict resolution — updating the snapshot or
+    raising AssertionError. Shared by expect() and expect_inline so the
+    comparison logic lives in a single code object.
+    """
+    if manager.has_snapshot(test_name):
+        if manager.matches(test_name, canonical):
+            print(f"✓ Test '{test_name}' passed")
+            return
+
+        # Conflict: values differ; round-trip to a plain Python
+        # structure for diffing
+        serialized_result = _loads(canonical)
+        existing = manager.get_snapshot(test_name)
+        if _handle_conflict(test_name, existing, serialized_result,
+                            manager, metadata):
+            manager.update_snapshot(test_name, serialized_result, metadata,
+                                    canonical)
+            print(f"✓ Updated snapshot for '{test_name}'")
+        else:
+            # Fail the test; the full payloads live in the snapshot
+            # file, so don't dump them here
+            stored = manager._canonical_cache.get(test_name)
+            expected_size = len(stored) if stored is not None else "unknown"
+            raise AssertionError(
+                f"Snapshot mismatch for test '{test_name}' "
+                f"(expected {expected_size} bytes, "
+                f"got {len(canonical)}); "
+                f"stored snapshot: {manager._shard_path(test_name)}"
+            )
+    else:
+        # No existing snapshot, create it
+        manager.update_snapshot(test_name, _loads(canonical), metadata,
+                                canonical)
+        print(f"✓ Created new snapshot for '{test_name}'")
+
+
+def expect(test_name: str, snapshot_dir: Optional[str] = None):
     """
     Decorator for expect tests.
-    
+
     Args:
         test_name: Unique name for the test
-        snapshot_file: Optional path to snapshot file (auto-detected if None)
-    
+        snapshot_dir: Optional path to snapshot directory (auto-detected if None)
+
     Usage:
         @expect("fibonacci_test")
         def test_fibonacci():
             return fibonacci(15)
     """
     def decorator(func: Callable) -> Callable:
+        # Capture the calling file and location metadata once at
+        # decoration time; it is already known from the function itself,
+        # so no per-call frame introspection is needed. The directory is
+        # still computed per call (a cheap path join, no syscalls) so a
+        # later set_snapshot_dir() is honoured; the manager lookup
+        # behind it is memoized.
+        caller_file = inspect.getfile(func)
+        test_metadata = {
+            "file_path": func.__code__.co_filename,
+            "line_number": func.__code__.co_firstlineno,
+            "function_name": func.__name__
+        }
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            # Get metadata about the test location
-            frame = inspect.currentframe()
-            metadata = {
-                "file_path": frame.f_code.co_filename,
-                "line_number": frame.f_lineno,
-                "function_name": func.__name__
-            }
-            
-            # Initialize snapshot manager
-            manager = SnapshotManager(snapshot_file)
-            
+            # Look up the shared snapshot manager
+            manager = _get_manager(snapshot_dir or _snapshot_dir_for(caller_file))
+
             # Execute the test function
             try:
                 result = func(*args, **kwargs)
-                serialized_result = _serialize_value(result)
+                canonical = _canonical_bytes(result)
             except Exception as e:
                 # If test raises an exception, that's the result we snapshot
-                serialized_result = {
+                canonical = _canonical_bytes({
                     "exception": str(type(e).__name__),
                     "message": str(e)
-                }
-            
-            # Calculate hash for change detection
-            result_hash = hashlib.md5(
-                json.dumps(serialized_result, sort_keys=True, default=str).encode()
-            ).hexdigest()
-            metadata["hash"] = result_hash
-            
-            # Check if we have an existing snapshot
-            if manager.has_snapshot(test_name):
-                existing = manager.get_snapshot(test_name)
-                
-                if existing != serialized_result:
-                    # Conflict: values differ
-                    if _handle_conflict(test_name, existing, serialized_result, 
-                                      manager, metadata):
-                        manager.update_snapshot(test_name, serialized_result, metadata)
-                        manager.commit_updates()
-                        print(f"✓ Updated snapshot for '{test_name}'")
-                    else:
-                        # Fail the test
-                        raise AssertionError(
-                            f"Snapshot mismatch for test '{test_name}'\n"
-                            f"Expected: {json.dumps(existing, indent=2)}\n"
-                            f"Got: {json.dumps(serialized_result, indent=2)}"
-                        )
-                else:
-                    print(f"✓ Test '{test_name}' passed")
-            else:
-                # No existing snapshot, create it
-                manager.update_snapshot(test_name, serialized_result, metadata)
-                manager.commit_updates()
-                print(f"✓ Created new snapshot for '{test_name}'")
-            
+                })
+
+            _compare_and_store(manager, test_name, canonical, test_metadata)
             return result
         
         return wrapper
@@ -313,14 +559,18 @@ def expect_inline(test_name: str):
             e.capture(result)
     """
     class InlineExpectContext:
-        def __init__(self, name: str):
+        def __init__(self, name: str, snapshot_dir: Optional[str] = None,
+                     metadata: Optional[dict] = None):
             self.name = name
-            self.manager = SnapshotManager()
+            self.manager = _get_manager(snapshot_dir)
+            self.metadata = metadata or {}
             self.captured = None
             
         def capture(self, value: Any):
             """Capture a value for comparison"""
-            self.captured = _serialize_value(value)
+            # Serialize immediately: mutating the object after capture()
+            # must not change what gets snapshotted
+            self.captured = _canonical_bytes(value) if value is not None else None
             
         def __enter__(self):
             return self
@@ -331,44 +581,30 @@ def expect_inline(test_name: str):
             
             # If an exception occurred, capture it
             if exc_type is not None:
-                self.captured = {
+                self.captured = _canonical_bytes({
                     "exception": str(exc_type.__name__),
                     "message": str(exc_val)
-                }
-            
-            # Get metadata
-            frame = inspect.currentframe()
-            metadata = {
-                "file_path": frame.f_code.co_filename,
-                "line_number": frame.f_lineno,
-                "hash": hashlib.md5(
-                    json.dumps(self.captured, sort_keys=True, default=str).encode()
-                ).hexdigest()
-            }
-            
-            # Handle snapshot comparison
-            if self.manager.has_snapshot(self.name):
-                existing = self.manager.get_snapshot(self.name)
-                if existing != self.captured:
-                    if _handle_conflict(self.name, existing, self.captured, 
-                                      self.manager, metadata):
-                        self.manager.update_snapshot(self.name, self.captured, metadata)
-                        self.manager.commit_updates()
-                        print(f"✓ Updated snapshot for '{self.name}'")
-                    else:
-                        raise AssertionError(f"Snapshot mismatch for test '{self.name}'")
-                else:
-                    print(f"✓ Test '{self.name}' passed")
-            else:
-                self.manager.update_snapshot(self.name, self.captured, metadata)
-                self.manager.commit_updates()
-                print(f"✓ Created new snapshot for '{self.name}'")
-            
+                })
+
+            _compare_and_store(self.manager, self.name, self.captured, self.metadata)
+
             # Suppress any exception if we're capturing it
             if exc_type is not None:
                 return True
-    
-    return InlineExpectContext(test_name)
+
+    # The caller is one frame up; capture its location once here rather
+    # than re-inspecting frames when the context exits
+    caller = inspect.currentframe().f_back
+    if caller is not None:
+        snapshot_dir = _snapshot_dir_for(caller.f_code.co_filename)
+        metadata = {
+            "file_path": caller.f_code.co_filename,
+            "line_number": caller.f_lineno
+        }
+    else:
+        snapshot_dir = None
+        metadata = None
+    return InlineExpectContext(test_name, snapshot_dir, metadata)
 
 
 # Utility functions for configuration